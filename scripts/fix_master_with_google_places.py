@@ -4,15 +4,27 @@
 from __future__ import annotations
 
 import csv
+import functools
+import hashlib
 import json
-import math
+from math import acos, asin, cos, pi, sin, sqrt
 import os
 import re
+import threading
 import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
+try:
+    import orjson  # 任意（入っていればキャッシュの読み書きを高速化）
+except ImportError:
+    orjson = None
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pykakasi import kakasi
 
 ROOT = Path(__file__).resolve().parents[1]
@@ -31,6 +43,10 @@ MAX_UPDATES = int(os.getenv("MAX_UPDATES", "200"))
 ONLY_BAD_ROWS = (os.getenv("ONLY_BAD_ROWS", "0") == "1")
 STRICT_ADDRESS_CHECK = (os.getenv("STRICT_ADDRESS_CHECK", "1") == "1")
 SLEEP_SEC = float(os.getenv("GOOGLE_API_SLEEP_SEC", "0.15"))
+# 行単位の API 処理を並列化するワーカー数（全体の送信間隔は SLEEP_SEC で共有制御）
+WORKERS = max(1, int(os.getenv("GOOGLE_API_WORKERS", "8")))
+# 空いている時に SLEEP_SEC を待たずに連続で送ってよい回数（平均レートは変わらない）
+API_BURST = max(1, int(os.getenv("GOOGLE_API_BURST", "1")))
 
 OVERWRITE_PHONE = (os.getenv("OVERWRITE_PHONE", "0") == "1")
 OVERWRITE_WEBSITE = (os.getenv("OVERWRITE_WEBSITE", "0") == "1")
@@ -48,18 +64,37 @@ OVERWRITE_STATION_KANA = (os.getenv("OVERWRITE_STATION_KANA", "1") == "1")
 FORCE_RECALC_STATION = (os.getenv("FORCE_RECALC_STATION", "0") == "1")
 
 NEARBY_RADIUS_M = int(os.getenv("NEARBY_RADIUS_M", "2500"))
+# Places API (New) を使う：施設は searchText 1回（geocode+details の代わり）、駅は searchNearby（鉄道系 types だけをサーバ側で絞り込む）
+PLACES_API_NEW = (os.getenv("PLACES_API_NEW", "0") == "1")
+# nearbysearch を rankby=distance&type=train_station で叩く（近い順・バス停なし。半径指定は無くなる）
+NEARBY_RANKBY_DISTANCE = (os.getenv("NEARBY_RANKBY_DISTANCE", "0") == "1")
+RANKBY_STATION_TYPES = ("train_station", "subway_station")
+WALK_M_PER_MIN = int(os.getenv("WALK_M_PER_MIN", "80"))  # 不動産表示の徒歩1分=80m
 FORCE_REBUILD_STATIONS = (os.getenv("FORCE_REBUILD_STATIONS", "0") == "1")
+# 行処理の前に、施設のあるマスごとに1回だけ nearbysearch して駅キャッシュを温める（行ごとの探索を減らす）
+PREFETCH_GRID = (os.getenv("PREFETCH_GRID", "0") == "1")
+PREFETCH_STEP_M = int(os.getenv("PREFETCH_STEP_M", str(NEARBY_RADIUS_M // 2)))
 
 STATION_CACHE = DATA_DIR / "stations_cache_yokohama.json"
 STATION_MISSES = DATA_DIR / "station_misses.csv"
-
-ALLOWED_STATION_TYPES = {
+MISS_FIELDS = ("facility_id", "name", "ward", "reason", "query_tried")
+
+# geocode / place_details の結果を実行をまたいで再利用する（再実行時の API 課金・待ち時間を削減）
+# data/ はワークフローがコミットするので置かない（.gitignore 済み。Actions では actions/cache で持ち越す）
+API_CACHE = ROOT / ".cache" / "google_api_cache.json"
+USE_API_CACHE = (os.getenv("USE_API_CACHE", "1") == "1")
+# キャッシュの有効日数（電話番号・URL の変更を拾うため古いものは引き直す。0 で無期限）
+API_CACHE_TTL_DAYS = float(os.getenv("API_CACHE_TTL_DAYS", "30"))
+# N 行処理するごとに master とキャッシュを途中保存する（0 で無効）
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", "50"))
+
+ALLOWED_STATION_TYPES = frozenset({
     "train_station",
     "subway_station",
     "light_rail_station",
     # transit_station は広すぎてバス停混入が起きやすいので、原則は許可しない
     # "transit_station",
-}
+})
 
 # 強制除外ワード（駅以外の混入を抑える）
 BAD_STATION_WORDS = [
@@ -71,44 +106,73 @@ BAD_STATION_WORDS = [
     "番地", "番", "号",
     "プラウド", "シティ", "レジデンス", "マンション", "団地", "ハイツ", "コーポ",
 ]
+# 上記ワードを1本の正規表現にまとめ、1回の search で判定する
+_BAD_WORDS_RE = re.compile("|".join(map(re.escape, BAD_STATION_WORDS)))
+_ADDR_NUM_RE = re.compile(r"\d+(?:丁目|番|号)")
+_PLACE_NAME_RE = re.compile(r"[一-龥ぁ-んァ-ヶー]{2,8}")
+_SPACES_RE = re.compile(r"\s+")
+_STATION_PREFIX_RE = re.compile(r"(.+?駅)")
+# 駅名に通常付かない語尾（endswith にタプルで渡して1回で判定）
+_NOT_STATION_SUFFIXES = ("前", "入口")
 
 # ---------------- small utils ----------------
 def safe(x: Any) -> str:
     return "" if x is None else str(x)
 
+def _s(x: Any) -> str:
+    # safe(x).strip() を1回で（str 値ならそのまま strip するだけ）
+    if x is None:
+        return ""
+    return (x if isinstance(x, str) else str(x)).strip()
+
 def norm_spaces(s: str) -> str:
     s = safe(s).replace("　", " ")
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _SPACES_RE.sub(" ", s).strip()
     return s
 
-def in_scope_address(addr: str, city: str, ward: Optional[str]) -> bool:
+# 住所に含まれているべき文字列（市・指定時は区）。起動時に1回だけ決める
+SCOPE_NEEDLES = tuple(x for x in (CITY_FILTER, WARD_FILTER) if x) if STRICT_ADDRESS_CHECK else ()
+
+@functools.lru_cache(maxsize=4096)
+def in_scope_address(addr: str) -> bool:
     a = safe(addr)
     if not a:
         return False
-    if STRICT_ADDRESS_CHECK:
-        if city and city not in a:
-            return False
-        if ward and ward not in a:
-            return False
-    return True
+    return all(x in a for x in SCOPE_NEEDLES)
 
-def write_csv(path: Path, rows: List[Dict[str, Any]], fieldnames: List[str]) -> None:
+def open_csv_writer(path: Path, fieldnames: Tuple[str, ...]) -> Tuple[Any, Any]:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8-sig", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for r in rows:
-            w.writerow({k: r.get(k, "") for k in fieldnames})
+    f = path.open("w", encoding="utf-8-sig", newline="")
+    w = csv.writer(f)
+    w.writerow(fieldnames)
+    return f, w
+
+# 地球半径(m)。math.* は名前で直接 import し、属性参照を省く
+EARTH_R = 6371000.0
+_DEG = pi / 180.0
+_EARTH_R2 = 2 * EARTH_R
 
 def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
-    R = 6371000.0
-    p1 = math.radians(lat1)
-    p2 = math.radians(lat2)
-    dlat = math.radians(lat2 - lat1)
-    dlng = math.radians(lng2 - lng1)
-    a = math.sin(dlat/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(dlng/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
+    # **2 / radians() / atan2 を避け、s*s と asin で計算（結果は同じ）
+    sdlat = sin((lat2 - lat1) * _DEG * 0.5)
+    sdlng = sin((lng2 - lng1) * _DEG * 0.5)
+    a = sdlat * sdlat + cos(lat1 * _DEG) * cos(lat2 * _DEG) * sdlng * sdlng
+    return _EARTH_R2 * asin(sqrt(min(1.0, a)))
+
+def to_unit_xyz(lat: float, lng: float) -> Tuple[float, float, float]:
+    # 緯度経度 → 単位球上の3次元ベクトル（内積が大きいほど近い）
+    p = lat * _DEG
+    l = lng * _DEG
+    cp = cos(p)
+    return (cp * cos(l), cp * sin(l), sin(p))
+
+def arc_m(dot: float) -> float:
+    # 単位ベクトルの内積 → 大円距離(m)
+    return EARTH_R * acos(max(-1.0, min(1.0, dot)))
+
+def walk_minutes_from_m(d: float) -> int:
+    # round(d / 80) を整数演算で（float除算・round を通さない）。最低1分
+    return max(1, (int(d) + WALK_M_PER_MIN // 2) // WALK_M_PER_MIN)
 
 # ---------------- kana (pykakasi) ----------------
 _KKS = kakasi()
@@ -120,52 +184,59 @@ _KKS.setMode("s", True)
 _KKS.setMode("C", True)
 _CONV = _KKS.getConverter()
 
-def to_hiragana(text: str) -> str:
-    t = norm_spaces(text)
-    if not t:
-        return ""
+@functools.lru_cache(maxsize=8192)
+def _cached_hira(t: str) -> str:
+    # 同じ駅名・園名は何度も出るので変換結果を使い回す
     try:
         return _CONV.do(t)
     except Exception:
         return ""
 
+def to_hiragana(text: str) -> str:
+    t = norm_spaces(text)
+    if not t:
+        return ""
+    return _cached_hira(t)
+
 # ---------------- station name rules ----------------
+@functools.lru_cache(maxsize=4096)
 def looks_like_station_name(name: str) -> bool:
-    n = safe(name).strip()
+    # 同じ駅名が多数の施設・候補で繰り返し出るのでメモ化する
+    n = _s(name)
     if not n:
         return False
 
     # 住所っぽい（〜丁目/〜番/〜号）は駅ではない
-    if re.search(r"\d+丁目", n) or re.search(r"\d+番", n) or re.search(r"\d+号", n):
+    if _ADDR_NUM_RE.search(n):
         return False
     if "丁目" in n or "番地" in n:
         return False
 
     # 「〜前」「〜入口」などは駅ではない（駅名に通常付かない）
-    if (n.endswith("前") or n.endswith("入口")) and ("駅" not in n):
+    if n.endswith(_NOT_STATION_SUFFIXES) and ("駅" not in n):
         return False
 
-    for w in BAD_STATION_WORDS:
-        if w in n:
-            return False
+    if _BAD_WORDS_RE.search(n):
+        return False
 
-    # “〇〇駅” はOK
-    if n.endswith("駅") or ("駅" in n):
+    # “〇〇駅” はOK（endswith は "in" に含まれるので1回で判定）
+    if "駅" in n:
         return True
 
     # 地名だけの短いものは “駅候補” としてはOK（ただし types 条件で絞る）
-    if re.fullmatch(r"[一-龥ぁ-んァ-ヶー]{2,8}", n):
+    if _PLACE_NAME_RE.fullmatch(n):
         return True
 
     return False
 
+@functools.lru_cache(maxsize=4096)
 def normalize_station_name(name: str) -> str:
-    n = safe(name).strip()
+    n = _s(name)
     if not n:
         return ""
     if n.endswith("駅"):
         return n
-    m = re.search(r"(.+?駅)", n)
+    m = _STATION_PREFIX_RE.search(n)
     if m:
         return m.group(1)
     if looks_like_station_name(n):
@@ -173,42 +244,310 @@ def normalize_station_name(name: str) -> str:
     return n
 
 def is_station_candidate(place: Dict[str, Any]) -> bool:
-    name = safe(place.get("name")).strip()
-    types = set(place.get("types") or [])
-
     # ★ train/subway/light_rail のみ許可（バス停混入を根絶）
-    if not (types & ALLOWED_STATION_TYPES):
+    # types は数要素なので set を作らず先頭から見る
+    if not any(t in ALLOWED_STATION_TYPES for t in (place.get("types") or ())):
         return False
 
+    name = _s(place.get("name"))
+
     if not looks_like_station_name(name):
         return False
 
     return True
 
+# ---------------- JSON file I/O ----------------
+def read_json(path: Path) -> Any:
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    return json.loads(path.read_text(encoding="utf-8"))
+
+def write_json(path: Path, obj: Any) -> None:
+    # どちらでも同じ出力（2スペースインデント・非ASCIIはそのまま）になるようにする
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    # 一時ファイルに書いてから差し替える（途中で落ちても壊れたキャッシュを残さない）
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+# ---------------- API cache (geocode / details) ----------------
+_api_cache: Dict[str, Dict[str, Any]] = {"geocode": {}, "details": {}, "place_v1": {}}
+
+def load_api_cache() -> None:
+    if not USE_API_CACHE or not API_CACHE.exists():
+        return
+    try:
+        obj = read_json(API_CACHE)
+    except Exception:
+        return
+    for kind in _api_cache:
+        _api_cache[kind] = obj.get(kind) or {}
+
+def save_api_cache() -> None:
+    if not USE_API_CACHE:
+        return
+    # ワーカーが追記中でも保存できるよう、dict をコピーしてから書く
+    API_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    write_json(API_CACHE, {kind: dict(d) for kind, d in _api_cache.items()})
+
+# USE_API_CACHE=0 でもメモリ上では使う（同一実行内の重複クエリは1回だけ叩く）
+_api_stats: Dict[str, int] = {"hit": 0, "miss": 0, "memo": 0, "station_local": 0}
+
+def api_cache_get(kind: str, key: str) -> Optional[Dict[str, Any]]:
+    hit = _api_cache[kind].get(key)
+    if hit and API_CACHE_TTL_DAYS > 0 and time.time() - hit.get("ts", 0) > API_CACHE_TTL_DAYS * 86400:
+        hit = None
+    # 集計表示用なのでロックは取らない
+    _api_stats["hit" if hit else "miss"] += 1
+    return hit.get("result") if hit else None
+
+def api_cache_put(kind: str, key: str, result: Dict[str, Any]) -> None:
+    _api_cache[kind][key] = {"ts": int(time.time()), "result": result}
+
 # ---------------- Google APIs ----------------
+# keep-alive 接続を使い回す。429/5xx は指数バックオフで数回だけ再送
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(16, WORKERS),
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "POST"]),
+))
+
+_rate_lock = threading.Lock()
+_next_send = 0.0
+_hold_until = 0.0
+# 実際の送信間隔。OVER_QUERY_LIMIT で倍に広げ、成功が続けば SLEEP_SEC まで少しずつ戻す（AIMD）
+_interval = SLEEP_SEC
+MAX_INTERVAL_SEC = 2.0
+
+def _throttle() -> None:
+    # 全スレッド共通のトークンバケット（平均 1/_interval 回/秒、空いていれば API_BURST 回まで連続送信）
+    # _next_send は「バケットが満杯に戻る」理論時刻。API_BURST=1 なら _interval 間隔の等間隔送信
+    global _next_send
+    with _rate_lock:
+        now = time.monotonic()
+        tat = max(_next_send, now)
+        slot = max(now, tat - (API_BURST - 1) * _interval, _hold_until)
+        _next_send = tat + _interval
+    wait = slot - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+
+def _hold(sec: float, widen: bool = False) -> None:
+    # 全スレッドの送信を sec 秒止める。widen なら以後の送信間隔も倍にする
+    global _hold_until, _interval, _next_send
+    with _rate_lock:
+        _hold_until = max(_hold_until, time.monotonic() + sec)
+        if widen:
+            # 上限は SLEEP_SEC 未満にしない（指定より速く送ることはしない）
+            _interval = min(max(MAX_INTERVAL_SEC, SLEEP_SEC), max(_interval * 2, 0.05))
+        # バケットも空にしておく（停止明けに待っていたスレッドが一斉に送らず、_interval 間隔で1件ずつ出る）
+        _next_send = max(_next_send, _hold_until + (API_BURST - 1) * _interval)
+
+def _backoff(sec: float) -> None:
+    # OVER_QUERY_LIMIT を受けたら全スレッドの送信を sec 秒止め、以後の送信間隔も倍にする
+    _hold(sec, widen=True)
+
+def _recover() -> None:
+    # 成功ごとに間隔を 5% 縮める（SLEEP_SEC より短くはしない）
+    global _interval
+    if _interval > SLEEP_SEC:
+        with _rate_lock:
+            _interval = max(SLEEP_SEC, _interval * 0.95)
+
+OVER_QUERY_LIMIT_RETRIES = 6
+
+# 同一実行内で同じ URL+params（POST は body+FieldMask）の応答を使い回す（ヒット時は待ち時間もかけない）
+_memo: OrderedDict[Tuple[str, Tuple[Tuple[str, str], ...]], Dict[str, Any]] = OrderedDict()
+_memo_lock = threading.Lock()
+MEMO_MAX = 2048
+
+def _memo_get(key: Tuple[str, Tuple[Tuple[str, str], ...]]) -> Optional[Dict[str, Any]]:
+    with _memo_lock:
+        hit = _memo.get(key)
+        if hit is not None:
+            _memo.move_to_end(key)
+            _api_stats["memo"] += 1
+        return hit
+
+def _memo_put(key: Tuple[str, Tuple[Tuple[str, str], ...]], js: Dict[str, Any]) -> None:
+    with _memo_lock:
+        _memo[key] = js
+        if len(_memo) > MEMO_MAX:
+            _memo.popitem(last=False)
+
+def resp_json(r: requests.Response) -> Dict[str, Any]:
+    # orjson があれば bytes から直接パース（無ければ requests 標準の json）
+    if orjson is not None:
+        return orjson.loads(r.content)
+    return r.json()
+
 def g_get(url: str, params: Dict[str, Any]) -> Dict[str, Any]:
-    time.sleep(SLEEP_SEC)
-    r = requests.get(url, params=params, timeout=30)
+    key = (url, tuple(sorted((k, str(v)) for k, v in params.items())))
+    hit = _memo_get(key)
+    if hit is not None:
+        return hit
+
+    # INVALID_REQUEST の再送は OVER_QUERY_LIMIT の再送回数 n とは別に数える
+    invalid_retried = False
+    n = 0
+    while True:
+        _throttle()
+        r = SESSION.get(url, params=params, timeout=30)
+        r.raise_for_status()
+        js = resp_json(r)
+        status = js.get("status")
+        # INVALID_REQUEST はまれに一過性で返るので、1回だけ少し待って送り直す（待ちは全スレッド共通）
+        if status == "INVALID_REQUEST" and not invalid_retried:
+            invalid_retried = True
+            _hold(0.5)
+            continue
+        if status != "OVER_QUERY_LIMIT":
+            _recover()
+            break
+        if n == OVER_QUERY_LIMIT_RETRIES:
+            break
+        _backoff(0.5 * 1.5 ** n)
+        n += 1
+
+    # 一時的なエラー（OVER_QUERY_LIMIT 等）は覚えない
+    if js.get("status") in ("OK", "ZERO_RESULTS"):
+        _memo_put(key, js)
+    return js
+
+def g_post(url: str, body: Dict[str, Any], field_mask: str) -> Dict[str, Any]:
+    # Places API (New) 用：キーと取得フィールドはヘッダで渡す
+    key = (url, (("body", json.dumps(body, sort_keys=True, ensure_ascii=False)), ("mask", field_mask)))
+    hit = _memo_get(key)
+    if hit is not None:
+        return hit
+    _throttle()
+    headers = {"X-Goog-Api-Key": API_KEY, "X-Goog-FieldMask": field_mask}
+    r = SESSION.post(url, json=body, headers=headers, timeout=30)
     r.raise_for_status()
-    return r.json()
+    js = resp_json(r)
+    _memo_put(key, js)
+    return js
+
+def v1_to_legacy(p: Dict[str, Any]) -> Dict[str, Any]:
+    # 新APIの place を従来（legacy）の形に寄せ、後段の判定ロジックをそのまま使う
+    loc = p.get("location") or {}
+    return {
+        "place_id": p.get("id"),
+        "name": (p.get("displayName") or {}).get("text"),
+        "geometry": {"location": {"lat": loc.get("latitude"), "lng": loc.get("longitude")}},
+        "types": p.get("types") or [],
+    }
+
+def query_key(query: str) -> str:
+    # 全角/半角・空白・英字の大小の揺れは同じキャッシュに当てる（送る文字列はそのまま）
+    return norm_spaces(unicodedata.normalize("NFKC", query)).lower()
 
 def geocode_place(query: str) -> Optional[Dict[str, Any]]:
+    ck = query_key(query)
+    hit = api_cache_get("geocode", ck)
+    if hit is not None:
+        return hit
     url = "https://maps.googleapis.com/maps/api/geocode/json"
     js = g_get(url, {"address": query, "key": API_KEY, "language": "ja", "region": "jp"})
     if js.get("status") != "OK":
         return None
-    return js["results"][0]
+    res = js["results"][0]
+    # 後段で使う項目だけ保存（address_components 等は捨ててキャッシュを小さく保つ）
+    geo = {
+        "place_id": res.get("place_id"),
+        "formatted_address": res.get("formatted_address"),
+        "geometry": {"location": (res.get("geometry") or {}).get("location")},
+        "types": res.get("types") or [],
+    }
+    api_cache_put("geocode", ck, geo)
+    return geo
+
+V1_PLACE_FIELDS = ",".join([
+    "places.id", "places.displayName", "places.formattedAddress", "places.location", "places.types",
+    "places.internationalPhoneNumber", "places.websiteUri", "places.googleMapsUri",
+])
+
+def search_place_v1(query: str) -> Optional[Dict[str, Any]]:
+    # 新API searchText で施設を1回で引き、place_details と同じ形（legacy）で返す
+    ck = query_key(query)
+    hit = api_cache_get("place_v1", ck)
+    if hit is not None:
+        return hit
+    url = "https://places.googleapis.com/v1/places:searchText"
+    js = g_post(url, {"textQuery": query, "languageCode": "ja", "regionCode": "jp", "pageSize": 1}, V1_PLACE_FIELDS)
+    places = js.get("places") or []
+    if not places:
+        return None
+    p = places[0]
+    det = v1_to_legacy(p)
+    det.update({
+        "formatted_address": p.get("formattedAddress") or "",
+        "international_phone_number": p.get("internationalPhoneNumber") or "",
+        "website": p.get("websiteUri") or "",
+        "url": p.get("googleMapsUri") or "",
+    })
+    api_cache_put("place_v1", ck, det)
+    return det
 
 def place_details(place_id: str) -> Optional[Dict[str, Any]]:
+    hit = api_cache_get("details", place_id)
+    if hit is not None:
+        return hit
     url = "https://maps.googleapis.com/maps/api/place/details/json"
     fields = "name,formatted_address,geometry/location,types,international_phone_number,website,url"
     js = g_get(url, {"place_id": place_id, "fields": fields, "key": API_KEY, "language": "ja"})
     if js.get("status") != "OK":
         return None
-    return js.get("result") or None
+    det = js.get("result") or None
+    if det:
+        api_cache_put("details", place_id, det)
+    return det
+
+V1_STATION_FIELDS = "places.id,places.displayName,places.types,places.location"
+
+def nearby_stations_v1(lat: float, lng: float, radius_m: int) -> List[Dict[str, Any]]:
+    url = "https://places.googleapis.com/v1/places:searchNearby"
+    js = g_post(url, {
+        "includedTypes": sorted(ALLOWED_STATION_TYPES),
+        "maxResultCount": 20,
+        "rankPreference": "DISTANCE",
+        "languageCode": "ja",
+        "regionCode": "jp",
+        "locationRestriction": {
+            "circle": {"center": {"latitude": lat, "longitude": lng}, "radius": float(radius_m)},
+        },
+    }, V1_STATION_FIELDS)
+    return [v1_to_legacy(p) for p in (js.get("places") or [])]
 
 def nearby_stations(lat: float, lng: float, radius_m: int) -> List[Dict[str, Any]]:
+    if PLACES_API_NEW:
+        return nearby_stations_v1(lat, lng, radius_m)
     url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+    if NEARBY_RANKBY_DISTANCE:
+        # rankby=distance は type を1つしか取れないので、地下鉄だけの駅（市営地下鉄など）用に種別ごとに叩いて合わせる
+        out: List[Dict[str, Any]] = []
+        seen = set()
+        for t in RANKBY_STATION_TYPES:
+            js = g_get(url, {
+                "location": f"{lat},{lng}",
+                "rankby": "distance",
+                "type": t,
+                "key": API_KEY,
+                "language": "ja",
+            })
+            if js.get("status") not in ("OK", "ZERO_RESULTS"):
+                continue
+            for p in js.get("results") or []:
+                pid = p.get("place_id")
+                if pid and pid in seen:
+                    continue
+                seen.add(pid)
+                out.append(p)
+        return out
     # type=transit_station は広いが、後段で train/subway の types のみ採用する
     js = g_get(url, {
         "location": f"{lat},{lng}",
@@ -221,7 +560,22 @@ def nearby_stations(lat: float, lng: float, radius_m: int) -> List[Dict[str, Any
         return []
     return js.get("results") or []
 
+def text_search_station_v1(lat: float, lng: float, radius_m: int, hint: str) -> List[Dict[str, Any]]:
+    # 新API searchText（駅判定に要る項目だけ取る。types は後段の is_station_candidate で絞る）
+    url = "https://places.googleapis.com/v1/places:searchText"
+    js = g_post(url, {
+        "textQuery": f"{hint} 駅",
+        "languageCode": "ja",
+        "regionCode": "jp",
+        "locationBias": {
+            "circle": {"center": {"latitude": lat, "longitude": lng}, "radius": float(radius_m)},
+        },
+    }, V1_STATION_FIELDS)
+    return [v1_to_legacy(p) for p in (js.get("places") or [])]
+
 def text_search_station(lat: float, lng: float, radius_m: int, hint: str) -> List[Dict[str, Any]]:
+    if PLACES_API_NEW:
+        return text_search_station_v1(lat, lng, radius_m, hint)
     url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
     q = f"{hint} 駅"
     js = g_get(url, {
@@ -237,58 +591,206 @@ def text_search_station(lat: float, lng: float, radius_m: int, hint: str) -> Lis
     return js.get("results") or []
 
 # ---------------- station cache ----------------
+_station_lock = threading.Lock()
+
 def load_station_cache() -> Dict[str, Any]:
     if FORCE_REBUILD_STATIONS and STATION_CACHE.exists():
         STATION_CACHE.unlink()
     if not STATION_CACHE.exists():
-        return {"stations": []}
+        return {"stations": [], "by_coord": {}, "scans": []}
     try:
-        return json.loads(STATION_CACHE.read_text(encoding="utf-8"))
+        obj = read_json(STATION_CACHE)
     except Exception:
-        return {"stations": []}
+        return {"stations": [], "by_coord": {}, "scans": []}
+    # 再計算指定時は座標→駅の結果・探索済み範囲を読み捨てる（今回の結果で作り直す）
+    if FORCE_RECALC_STATION or not isinstance(obj.get("by_coord"), dict):
+        obj["by_coord"] = {}
+    if FORCE_RECALC_STATION or not isinstance(obj.get("scans"), list):
+        obj["scans"] = []
+    return obj
 
 def save_station_cache(obj: Dict[str, Any]) -> None:
-    STATION_CACHE.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    # "_" で始まるキーは実行中だけの索引なので保存しない
+    with _station_lock:
+        snap = {k: (v.copy() if isinstance(v, (list, dict)) else v) for k, v in obj.items() if not k.startswith("_")}
+    write_json(STATION_CACHE, snap)
+
+def place_coords(place: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    # place の geometry.location を (lat, lng) の float に（読めなければ None）
+    loc = (place.get("geometry") or {}).get("location") or {}
+    try:
+        return float(loc.get("lat")), float(loc.get("lng"))
+    except (TypeError, ValueError):
+        return None
 
 def upsert_station_cache(cache: Dict[str, Any], place: Dict[str, Any]) -> None:
     pid = safe(place.get("place_id"))
     if not pid:
         return
-    items = cache.setdefault("stations", [])
-    if any(s.get("place_id") == pid for s in items):
-        return
     name = safe(place.get("name"))
     loc = (place.get("geometry") or {}).get("location") or {}
-    items.append({
-        "place_id": pid,
-        "name": normalize_station_name(name),
-        "lat": loc.get("lat"),
-        "lng": loc.get("lng"),
-        "types": place.get("types") or [],
-    })
+    with _station_lock:
+        items = cache.setdefault("stations", [])
+        # place_id の索引は初回に作り、以後は O(1) で重複判定する
+        index = cache.get("_pid_index")
+        if index is None:
+            index = cache["_pid_index"] = {safe(s.get("place_id")) for s in items}
+        if pid in index:
+            return
+        index.add(pid)
+        items.append({
+            "place_id": pid,
+            "name": normalize_station_name(name),
+            "lat": loc.get("lat"),
+            "lng": loc.get("lng"),
+            "types": place.get("types") or [],
+        })
+
+def choose_best_station(
+    lat: float, lng: float, candidates: List[Dict[str, Any]]
+) -> Tuple[Optional[Dict[str, Any]], Optional[float], Optional[Tuple[float, float]]]:
+    # (最寄り候補, 距離m, 座標) を返す。距離は順位付けと同じ1回の計算を徒歩分にも流用する
+    # 判定→座標→内積を1パスで行い、内積最大（=最も近い）だけを残す（acos は勝者の1回だけ）
+    qx, qy, qz = to_unit_xyz(lat, lng)
+    first = None
+    best, best_dot, best_pt = None, -2.0, None
+    for p in candidates:
+        if not is_station_candidate(p):
+            continue
+        if first is None:
+            first = p
+        c = place_coords(p)
+        if c is None:
+            continue
+        x, y, z = to_unit_xyz(c[0], c[1])
+        dot = qx * x + qy * y + qz * z
+        if dot > best_dot:
+            best, best_dot, best_pt = p, dot, c
+
+    if best is None:
+        # 座標が読める候補が無ければ従来どおり先頭の候補（距離なし）
+        return first, None, None
+    return best, arc_m(best_dot), best_pt
 
-def choose_best_station(lat: float, lng: float, candidates: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
-    good = [p for p in candidates if is_station_candidate(p)]
-    if not good:
+# nearbysearch 1ページの上限件数。これ未満なら半径内の駅は取りこぼしなし（完全探索）とみなす
+NEARBY_PAGE_MAX = 20
+
+def _sync_xyz(items: List[Any], xyz: List[Any], conv: Any) -> None:
+    # items は追記のみなので、未変換の末尾だけ単位ベクトルに変換して xyz を揃える
+    for it in items[len(xyz):]:
+        try:
+            xyz.append(conv(it))
+        except (KeyError, IndexError, TypeError, ValueError):
+            xyz.append(None)
+
+def local_nearest_station(lat: float, lng: float, radius_m: int, cache: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], float]]:
+    # キャッシュ済み駅で最寄りを求め、その距離の円が過去の完全探索の円に収まる場合だけ採用する
+    # （収まっていれば、それより近い駅は必ずキャッシュに入っている）
+    # 駅・探索円とも単位ベクトルを使い回し、1件あたり内積1回で判定する
+    with _station_lock:
+        stations = cache.get("stations") or []
+        scans = cache.get("scans") or []
+        if not scans:
+            return None
+        st_xyz = cache.setdefault("_st_xyz", [])
+        sc_xyz = cache.setdefault("_scan_xyz", [])
+        _sync_xyz(stations, st_xyz, lambda st: to_unit_xyz(float(st["lat"]), float(st["lng"])))
+        _sync_xyz(scans, sc_xyz, lambda sc: (*to_unit_xyz(float(sc[0]), float(sc[1])), float(sc[2])))
+        st_pairs = list(zip(stations, st_xyz))
+        sc_list = list(sc_xyz)
+
+    qx, qy, qz = to_unit_xyz(lat, lng)
+    best, best_dot = None, -2.0
+    for st, v in st_pairs:
+        if v is None:
+            continue
+        dot = qx * v[0] + qy * v[1] + qz * v[2]
+        if dot > best_dot:
+            best, best_dot = st, dot
+    if best is None:
+        return None
+    best_d = arc_m(best_dot)
+    if best_d > radius_m:
         return None
 
-    def dist(p):
-        loc = (p.get("geometry") or {}).get("location") or {}
+    # 施設→探索中心の距離 <= r - best_d  ⇔  内積 >= cos((r - best_d) / R)
+    thr: Dict[float, float] = {}
+    for v in sc_list:
+        if v is None:
+            continue
+        x, y, z, r = v
+        if r <= best_d:
+            continue
+        t = thr.get(r)
+        if t is None:
+            t = thr[r] = cos((r - best_d) / EARTH_R)
+        if qx * x + qy * y + qz * z >= t:
+            return best, best_d
+    return None
+
+def scan_nearby(lat: float, lng: float, radius_m: int, cache: Dict[str, Any]) -> List[Dict[str, Any]]:
+    cands = nearby_stations(lat, lng, radius_m)
+    # rankby=distance は半径で区切らないので、探索範囲としては記録しない
+    if len(cands) < NEARBY_PAGE_MAX and not NEARBY_RANKBY_DISTANCE:
+        # 取りこぼしのない探索結果なので、駅候補を全部キャッシュし探索範囲として記録する
+        for p in cands:
+            if is_station_candidate(p):
+                upsert_station_cache(cache, p)
+        with _station_lock:
+            cache["scans"].append([round(lat, 6), round(lng, 6), radius_m])
+    return cands
+
+def grid_centers(points: List[Tuple[float, float]], step_m: int) -> List[Tuple[float, float]]:
+    # 施設座標を step_m 四方のマスに振り分け、施設のあるマスの中心だけを返す
+    if not points or step_m <= 0:
+        return []
+    lat0 = min(p[0] for p in points)
+    lng0 = min(p[1] for p in points)
+    dlat = step_m / 111320.0
+    dlng = step_m / (111320.0 * cos(lat0 * _DEG))
+    cells = {(int((a - lat0) // dlat), int((b - lng0) // dlng)) for a, b in points}
+    return [(lat0 + (i + 0.5) * dlat, lng0 + (j + 0.5) * dlng) for i, j in sorted(cells)]
+
+def prefetch_cell(center: Tuple[float, float], cache: Dict[str, Any]) -> bool:
+    # 先読みはキャッシュを温めるだけなので、1マス失敗しても止めない（その行は行ごとの探索に任せる）
+    try:
+        scan_nearby(center[0], center[1], NEARBY_RADIUS_M, cache)
+        return True
+    except Exception as e:
+        print(f"prefetch failed at {center[0]:.6f},{center[1]:.6f}: {e}")
+        return False
+
+def coord_key(lat: float, lng: float, radius_m: int) -> str:
+    # 0.0001度 ≒ 11m 単位に丸める（同じ建物・近接施設は同じキーになる）
+    return f"{round(lat, 4):.4f},{round(lng, 4):.4f},{radius_m}"
+
+def nearest_station_for(lat: float, lng: float, hint_name: str, radius_m: int, cache: Dict[str, Any]) -> Tuple[Optional[str], Optional[int], Optional[str]]:
+    key = coord_key(lat, lng, radius_m)
+    with _station_lock:
+        hit = cache.setdefault("by_coord", {}).get(key)
+    if hit:
+        _api_stats["station_local"] += 1
+        # 駅は丸め座標で共有し、徒歩分は施設の正確な座標から計算し直す
         try:
-            return haversine_m(lat, lng, float(loc.get("lat")), float(loc.get("lng")))
+            walk = walk_minutes_from_m(haversine_m(lat, lng, float(hit["lat"]), float(hit["lng"])))
         except Exception:
-            return 1e18
+            walk = None
+        return hit.get("name") or None, walk, hit.get("place_id") or None
 
-    good.sort(key=dist)
-    return good[0]
+    local = local_nearest_station(lat, lng, radius_m, cache)
+    if local is not None:
+        _api_stats["station_local"] += 1
+        st, d = local
+        with _station_lock:
+            cache["by_coord"][key] = {"place_id": st.get("place_id"), "name": st.get("name"), "lat": st.get("lat"), "lng": st.get("lng")}
+        return st.get("name") or None, walk_minutes_from_m(d), st.get("place_id") or None
 
-def nearest_station_for(lat: float, lng: float, hint_name: str, radius_m: int, cache: Dict[str, Any]) -> Tuple[Optional[str], Optional[int], Optional[str]]:
-    cands = nearby_stations(lat, lng, radius_m)
-    best = choose_best_station(lat, lng, cands)
+    cands = scan_nearby(lat, lng, radius_m, cache)
+    best, d, pt = choose_best_station(lat, lng, cands)
 
     if best is None:
         cands2 = text_search_station(lat, lng, radius_m, hint_name)
-        best = choose_best_station(lat, lng, cands2)
+        best, d, pt = choose_best_station(lat, lng, cands2)
 
     if best is None:
         return None, None, None
@@ -297,14 +799,11 @@ def nearest_station_for(lat: float, lng: float, hint_name: str, radius_m: int, c
 
     name = normalize_station_name(safe(best.get("name")))
     pid = safe(best.get("place_id")) or None
+    walk = walk_minutes_from_m(d) if d is not None else None
 
-    loc = (best.get("geometry") or {}).get("location") or {}
-    try:
-        d = haversine_m(lat, lng, float(loc.get("lat")), float(loc.get("lng")))
-        walk = int(round(d / 80.0))
-        walk = max(1, walk)
-    except Exception:
-        walk = None
+    if name and pt is not None:
+        with _station_lock:
+            cache["by_coord"][key] = {"place_id": pid, "name": name, "lat": pt[0], "lng": pt[1]}
 
     return name, walk, pid
 
@@ -318,198 +817,344 @@ def read_master_rows() -> Tuple[List[Dict[str, str]], List[str]]:
         fields = r.fieldnames or []
     return rows, fields
 
-def write_master_rows(rows: List[Dict[str, str]], fields: List[str]) -> None:
+def write_master_rows(rows: List[Dict[str, str]], fields: List[str], changed: bool = True) -> bool:
     want_cols = [
         "facility_id","name","ward","address","lat","lng","map_url",
         "facility_type","phone","website","notes",
         "nearest_station","walk_minutes",
-        "name_kana","station_kana",
+        "name_kana","station_kana","address_hash",
     ]
+    added = False
     for c in want_cols:
         if c not in fields:
             fields.append(c)
+            added = True
 
-    with MASTER_CSV.open("w", encoding="utf-8-sig", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=fields)
-        w.writeheader()
-        for row in rows:
-            w.writerow({k: row.get(k, "") for k in fields})
+    # 値も列も変わっていなければ書き直さない
+    if not changed and not added:
+        return False
 
+    # 一時ファイルに1行ずつ書いてから差し替える（途中で落ちても元の CSV は壊れない）
+    cols = tuple(fields)
+    tmp = MASTER_CSV.with_name(MASTER_CSV.name + ".tmp")
+    # 1 MiB バッファでまとめて書く（None / "" は or "" の1回で空に寄せる）
+    with tmp.open("w", encoding="utf-8-sig", newline="", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(cols)
+        w.writerows([row.get(k) or "" for k in cols] for row in rows)
+    os.replace(tmp, MASTER_CSV)
+    return True
+
+@functools.lru_cache(maxsize=2048)
 def bad_station_value(st: str) -> bool:
-    s = safe(st).strip()
-    if s == "" or s.lower() == "null" or s == "-":
-        return True
+    s = _s(st)
     # “駅” が無い値は基本NG（地名だけを駅扱いするのは、ここではしない）
+    # 空 / "null" / "-" もここで落ちるので、正規表現まで行くのは “〇〇駅” だけ
     if not s.endswith("駅"):
         return True
-    for w in BAD_STATION_WORDS:
-        if w in s:
+    return _BAD_WORDS_RE.search(s) is not None
+
+# かな反映時に比較する列（行ごとに1回だけ strip 済みの現在値を作る）
+KANA_COLS = ("name_kana", "station_kana", "nearest_station")
+
+def snapshot(row: Dict[str, str], cols: Tuple[str, ...]) -> Dict[str, str]:
+    return {k: _s(row.get(k)) for k in cols}
+
+def set_if(dst: Dict[str, str], cur: Dict[str, str], col: str, val: Any, overwrite: bool) -> int:
+    # 現在値 cur[col] と比べ、変わる場合だけ dst[col] に書く
+    v = _s(val)
+    if v == "":
+        return 0
+    old = cur.get(col, "")
+    if overwrite or old == "":
+        if old != v:
+            dst[col] = v
+            return 1
+    return 0
+
+def address_hash(addr: str) -> str:
+    # geocode で書いた住所の指紋（手で直された住所だけ引き直す判定に使う）
+    return hashlib.sha1(norm_spaces(addr).encode("utf-8")).hexdigest()[:16]
+
+def normalized_row(row: Dict[str, str]) -> Dict[str, str]:
+    # DictReader の値は str か None（列不足）。余剰列のキー None は捨てる
+    return {k: (v or "").strip() for k, v in row.items() if k is not None}
+
+EMPTY_WALK = ("", "null", "-")
+
+def row_needs(row: Dict[str, str]) -> bool:
+    # 生の row に対して安い判定から順に見る（正規化スナップショットは対象行だけ作る）
+    st0 = _s(row.get("nearest_station"))
+    wk0 = _s(row.get("walk_minutes"))
+
+    if ONLY_BAD_ROWS:
+        return wk0 in EMPTY_WALK or bad_station_value(st0) or not in_scope_address(_s(row.get("address")))
+
+    if FILL_NEAREST_STATION:
+        if FORCE_RECALC_STATION or wk0 in EMPTY_WALK or bad_station_value(st0):
+            return True
+    if not (_s(row.get("address")) and _s(row.get("lat")) and _s(row.get("lng"))):
+        return True
+    # かなだけ直したいケース（住所等が揃っていても）
+    if FILL_KANA:
+        if (st0 and not _s(row.get("station_kana"))) or (_s(row.get("name")) and not _s(row.get("name_kana"))):
             return True
     return False
 
+def geocode_row(
+    cur: Dict[str, str], name: str, ward: str, q: str, need_details: bool,
+    upd: Dict[str, str], misses: List[Dict[str, Any]],
+) -> Tuple[Optional[str], Optional[str]]:
+    # geocode(+details) して住所・座標・連絡先を upd に積む。範囲外/失敗なら (None, None)
+    fid = cur.get("facility_id", "")
+    geo = search_place_v1(q) if PLACES_API_NEW else geocode_place(q)
+    if not geo:
+        misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": "geocode_failed", "query_tried": q})
+        return None, None
+
+    # geocode の住所で既に範囲外なら details（高い SKU）を叩かずに打ち切る
+    if STRICT_ADDRESS_CHECK and not in_scope_address(safe(geo.get("formatted_address"))):
+        misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": "address_out_of_scope", "query_tried": q})
+        return None, None
+
+    place_id = safe(geo.get("place_id"))
+    if PLACES_API_NEW:
+        det = geo  # searchText が電話・Web・地図URLまで返している
+    else:
+        det = place_details(place_id) if (place_id and need_details) else None
+    # details を使わず geocode の結果で代用したか（Geocoding の住所は建物名などが落ちやすい）
+    geocode_only = not det
+    if not det:
+        det = {
+            "name": name,
+            "formatted_address": (geo.get("formatted_address") if geo else ""),
+            "geometry": geo.get("geometry"),
+            "types": geo.get("types") or [],
+            "url": "",
+            "website": "",
+            "international_phone_number": "",
+        }
+
+    formatted_address = _s(det.get("formatted_address"))
+    loc = ((det.get("geometry") or {}).get("location") or {})
+    lat = _s(loc.get("lat"))
+    lng = _s(loc.get("lng"))
+
+    if STRICT_ADDRESS_CHECK and not in_scope_address(formatted_address):
+        misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": "address_out_of_scope", "query_tried": q})
+        return None, None
+
+    # 住所系は基本上書き（揺れ修正）。geocode で代用したときは、既存の値を Geocoding の値で置き換えない
+    loc_ow = not geocode_only
+    assignments = (
+        ("address", formatted_address, loc_ow),
+        ("lat", lat, loc_ow),
+        ("lng", lng, loc_ow),
+        ("facility_type", ",".join(det.get("types") or []), loc_ow),
+        ("phone", det.get("international_phone_number"), OVERWRITE_PHONE),
+        ("website", det.get("website"), OVERWRITE_WEBSITE),
+        ("map_url", det.get("url"), OVERWRITE_MAP_URL),
+    )
+    for col, val, ow in assignments:
+        set_if(upd, cur, col, val, ow)
+    # 指紋は、行に残る住所がこの実行で取った住所と同じときだけ付ける
+    if formatted_address and upd.get("address", cur.get("address", "")) == formatted_address:
+        set_if(upd, cur, "address_hash", address_hash(formatted_address), True)
+    # 駅探索は行に残る座標で行う
+    return upd.get("lat") or cur.get("lat", ""), upd.get("lng") or cur.get("lng", "")
+
+def process_row(cur: Dict[str, str], cache: Dict[str, Any]) -> Dict[str, Any]:
+    # ワーカースレッドで実行：正規化済みスナップショットだけを読み、更新内容を返す（row は触らない）
+    fid = cur.get("facility_id", "")
+    name = norm_spaces(cur.get("name", ""))
+    ward = cur.get("ward", "")
+    st0  = cur.get("nearest_station", "")
+    wk0  = cur.get("walk_minutes", "")
+
+    upd: Dict[str, str] = {}
+    misses: List[Dict[str, Any]] = []
+    out = {"ok": False, "upd": upd, "misses": misses, "station_changed": False}
+
+    q = " ".join([name, ward, CITY_FILTER, "日本"]).strip()
+
+    # 電話・Web・地図URL がどれも埋まっていて上書きもしないなら、details は叩かない
+    # （住所・座標・types は geocode の結果で足りる）
+    need_details = (
+        OVERWRITE_PHONE or OVERWRITE_WEBSITE or OVERWRITE_MAP_URL
+        or not (cur.get("phone") and cur.get("website") and cur.get("map_url"))
+    )
+
+    # 住所が前回 geocode で書いたままなら、Places は引き直さず保存済みの座標で駅（・かな）だけ直す
+    addr0 = cur.get("address", "")
+    lat, lng = cur.get("lat", ""), cur.get("lng", "")
+    reuse = (
+        addr0 and lat and lng and not need_details
+        and cur.get("address_hash") == address_hash(addr0)
+        and in_scope_address(addr0)
+    )
+    if not reuse:
+        lat, lng = geocode_row(cur, name, ward, q, need_details, upd, misses)
+        if lat is None:
+            return out
+    out["ok"] = True
+
+    # nearest station（強制再計算オプションあり）
+    if FILL_NEAREST_STATION and lat and lng:
+        try:
+            st_name, walk_min, _ = nearest_station_for(float(lat), float(lng), name, NEARBY_RADIUS_M, cache)
+            if st_name:
+                if FORCE_RECALC_STATION or OVERWRITE_NEAREST_STATION or bad_station_value(st0) or st0 == "":
+                    if st0 != st_name:
+                        upd["nearest_station"] = st_name
+                        out["station_changed"] = True
+
+            if walk_min is not None:
+                if FORCE_RECALC_STATION or OVERWRITE_WALK_MINUTES or wk0 in EMPTY_WALK:
+                    if wk0 != str(walk_min):
+                        upd["walk_minutes"] = str(walk_min)
+        except Exception as e:
+            misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": f"station_failed:{e}", "query_tried": q})
+
+    return out
+
+def apply_kana(row: Dict[str, str], station_changed: bool) -> int:
+    # pykakasi のスレッド安全性が不明なので、かな変換はメインスレッドで行う
+    c = 0
+    name = norm_spaces(row.get("name", ""))
+    cur = snapshot(row, KANA_COLS)
+    # 園名かな
+    if name:
+        nk_new = to_hiragana(name)
+        if nk_new:
+            c += set_if(row, cur, "name_kana", nk_new, OVERWRITE_NAME_KANA or cur["name_kana"] == "")
+
+    # 駅かな（駅が変わった、または空、または強制上書き）
+    st_now = cur["nearest_station"]
+    if st_now and not bad_station_value(st_now):
+        sk_new = to_hiragana(st_now)
+        if sk_new:
+            overwrite = OVERWRITE_STATION_KANA or station_changed or FORCE_RECALC_STATION or (cur["station_kana"] == "")
+            c += set_if(row, cur, "station_kana", sk_new, overwrite)
+    else:
+        # 駅が不正/空なら station_kana も空に寄せる（検索誤爆を防ぐ）
+        if cur["station_kana"] != "":
+            row["station_kana"] = ""
+            c += 1
+    return c
+
 def main() -> None:
     rows, fields = read_master_rows()
 
     target_ward = WARD_FILTER.strip() if WARD_FILTER else None
     cache = load_station_cache()
+    load_api_cache()
+
+    # misses は発生した時点で追記・flush する（途中で落ちてもそこまでは残る）
+    miss_f = None
+    miss_w = None
+    n_misses = 0
+
+    def add_misses(items: List[Dict[str, Any]]) -> None:
+        nonlocal miss_f, miss_w, n_misses
+        if not items:
+            return
+        if miss_w is None:
+            miss_f, miss_w = open_csv_writer(STATION_MISSES, MISS_FIELDS)
+        miss_w.writerows([m.get(k, "") for k in MISS_FIELDS] for m in items)
+        miss_f.flush()
+        n_misses += len(items)
 
-    misses: List[Dict[str, Any]] = []
     updated_cells = 0
     updated_rows = 0
+    dirty = False  # 最後に master を書いてから変更があったか
 
     scanned = 0
     skipped_by_ward = 0
     needs_true = 0
     tried = 0
 
-    def set_if(row: Dict[str, str], col: str, val: Any, overwrite: bool) -> int:
-        v = safe(val).strip()
-        if v == "":
-            return 0
-        cur = safe(row.get(col)).strip()
-        if overwrite or cur == "":
-            if cur != v:
-                row[col] = v
-                return 1
-        return 0
-
-    for row in rows:
-        scanned += 1
-
-        fid = safe(row.get("facility_id")).strip()
-        name = norm_spaces(row.get("name", ""))
-        ward = safe(row.get("ward")).strip()
-
-        if target_ward and target_ward not in ward:
-            skipped_by_ward += 1
-            continue
-
-        addr0 = safe(row.get("address")).strip()
-        lat0 = safe(row.get("lat")).strip()
-        lng0 = safe(row.get("lng")).strip()
-        st0  = safe(row.get("nearest_station")).strip()
-        wk0  = safe(row.get("walk_minutes")).strip()
-
-        # 更新対象判定
-        needs = False
-        if ONLY_BAD_ROWS:
-            if (not in_scope_address(addr0, CITY_FILTER, target_ward)) or bad_station_value(st0) or wk0 in ("", "null", "-"):
-                needs = True
-        else:
-            if (not addr0) or (not lat0) or (not lng0):
-                needs = True
-            if FILL_NEAREST_STATION:
-                if FORCE_RECALC_STATION:
-                    needs = True
-                elif (not st0) or bad_station_value(st0) or (wk0 in ("", "null", "-")):
-                    needs = True
-            # かなだけ直したいケース（住所等が揃っていても）
-            if FILL_KANA:
-                if (safe(row.get("station_kana")).strip() == "" and st0) or (safe(row.get("name_kana")).strip() == "" and name):
-                    needs = True
-
-        if not needs:
-            continue
-        needs_true += 1
-
-        if updated_rows >= MAX_UPDATES:
-            break
-        tried += 1
-
-        # --- geocode ---
-        q = " ".join([name, ward, CITY_FILTER, "日本"]).strip()
-        geo = geocode_place(q)
-        if not geo:
-            misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": "geocode_failed", "query_tried": q})
-            continue
-
-        place_id = safe(geo.get("place_id"))
-        det = place_details(place_id) if place_id else None
-        if not det:
-            det = {
-                "name": name,
-                "formatted_address": (geo.get("formatted_address") if geo else ""),
-                "geometry": geo.get("geometry"),
-                "types": geo.get("types") or [],
-                "url": "",
-                "website": "",
-                "international_phone_number": "",
-            }
-
-        formatted_address = safe(det.get("formatted_address")).strip()
-        loc = ((det.get("geometry") or {}).get("location") or {})
-        lat = safe(loc.get("lat")).strip()
-        lng = safe(loc.get("lng")).strip()
-
-        if STRICT_ADDRESS_CHECK and not in_scope_address(formatted_address, CITY_FILTER, target_ward):
-            misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": "address_out_of_scope", "query_tried": q})
+    # 1) 更新対象の行を先に列挙（打ち切り時の集計用に走査位置も控える）
+    todo: List[Tuple[Dict[str, str], Dict[str, str], int, int]] = []
+    n_skip = 0
+    for i, row in enumerate(rows, 1):
+        if target_ward and target_ward not in (row.get("ward") or ""):
+            n_skip += 1
             continue
-
-        c = 0
-        # 住所系は基本上書き（揺れ修正）
-        c += set_if(row, "address", formatted_address, True)
-        c += set_if(row, "lat", lat, True)
-        c += set_if(row, "lng", lng, True)
-        c += set_if(row, "facility_type", ",".join(det.get("types") or []), True)
-        c += set_if(row, "phone", det.get("international_phone_number"), OVERWRITE_PHONE)
-        c += set_if(row, "website", det.get("website"), OVERWRITE_WEBSITE)
-        c += set_if(row, "map_url", det.get("url"), OVERWRITE_MAP_URL)
-
-        # nearest station（強制再計算オプションあり）
-        station_changed = False
-        if FILL_NEAREST_STATION and lat and lng:
-            try:
-                st_name, walk_min, _ = nearest_station_for(float(lat), float(lng), name, NEARBY_RADIUS_M, cache)
-                if st_name:
-                    if FORCE_RECALC_STATION or OVERWRITE_NEAREST_STATION or bad_station_value(st0) or st0 == "":
-                        if safe(row.get("nearest_station")).strip() != st_name:
-                            row["nearest_station"] = st_name
-                            c += 1
-                            station_changed = True
-
-                if walk_min is not None:
-                    if FORCE_RECALC_STATION or OVERWRITE_WALK_MINUTES or wk0 in ("", "null", "-"):
-                        if safe(row.get("walk_minutes")).strip() != str(walk_min):
-                            row["walk_minutes"] = str(walk_min)
-                            c += 1
-            except Exception as e:
-                misses.append({"facility_id": fid, "name": name, "ward": ward, "reason": f"station_failed:{e}", "query_tried": q})
-
-        # ★ kana は “最新化” が目的なので、駅名が変わったら必ず更新する
-        if FILL_KANA:
-            # 園名かな
-            if name:
-                nk_new = to_hiragana(name)
-                if nk_new:
-                    c += set_if(row, "name_kana", nk_new, OVERWRITE_NAME_KANA or safe(row.get("name_kana")).strip() == "")
-
-            # 駅かな（駅が変わった、または空、または強制上書き）
-            st_now = safe(row.get("nearest_station")).strip()
-            if st_now and not bad_station_value(st_now):
-                sk_new = to_hiragana(st_now)
-                if sk_new:
-                    overwrite = OVERWRITE_STATION_KANA or station_changed or FORCE_RECALC_STATION or (safe(row.get("station_kana")).strip() == "")
-                    c += set_if(row, "station_kana", sk_new, overwrite)
-            else:
-                # 駅が不正/空なら station_kana も空に寄せる（検索誤爆を防ぐ）
-                if safe(row.get("station_kana")).strip() != "":
-                    row["station_kana"] = ""
-                    c += 1
-
-        if c > 0:
-            updated_cells += c
-            updated_rows += 1
+        if row_needs(row):
+            todo.append((row, normalized_row(row), i, n_skip))
+    scanned = len(rows)
+    skipped_by_ward = n_skip
+    needs_true = len(todo)
+
+    # 2) API 処理を並列実行し、結果は元の行順で反映（MAX_UPDATES 到達で打ち切り）
+    window = WORKERS * 2
+    with ThreadPoolExecutor(max_workers=WORKERS) as ex:
+        if FILL_NEAREST_STATION and PREFETCH_GRID:
+            points = []
+            for _, n, _, _ in todo:
+                try:
+                    points.append((float(n.get("lat", "")), float(n.get("lng", ""))))
+                except ValueError:
+                    continue
+            centers = grid_centers(points, PREFETCH_STEP_M)
+            failed = sum(1 for ok in ex.map(lambda c: prefetch_cell(c, cache), centers) if not ok)
+            print(f"prefetch: cells={len(centers)} failed={failed} stations={len(cache.get('stations') or [])}")
+
+        futs = []
+        nxt = 0
+        try:
+            for j, (row, _, pos, skip_at) in enumerate(todo):
+                # 先行投入は残り更新枠まで（打ち切り後に捨てる行で課金しない）
+                while nxt < len(todo) and nxt < j + min(window, MAX_UPDATES - updated_rows):
+                    futs.append(ex.submit(process_row, todo[nxt][1], cache))
+                    nxt += 1
+
+                if updated_rows >= MAX_UPDATES:
+                    scanned, skipped_by_ward, needs_true = pos, skip_at, j + 1
+                    break
+                tried += 1
+
+                res = futs[j].result()
+                add_misses(res["misses"])
+                if res["ok"]:
+                    upd = res["upd"]
+                    row.update(upd)
+                    c = len(upd)
+                    # ★ kana は “最新化” が目的なので、駅名が変わったら必ず更新する
+                    if FILL_KANA:
+                        c += apply_kana(row, res["station_changed"])
+
+                    if c > 0:
+                        updated_cells += c
+                        updated_rows += 1
+                        dirty = True
+
+                # 失敗した行でも区切りに来たら保存する（失敗行で途中保存を飛ばさない）
+                if CHECKPOINT_EVERY > 0 and tried % CHECKPOINT_EVERY == 0:
+                    # 途中で落ちても、ここまでの更新と API 結果は次回に引き継げる
+                    save_station_cache(cache)
+                    save_api_cache()
+                    if write_master_rows(rows, fields, dirty):
+                        dirty = False
+        except BaseException:
+            # 例外・Ctrl-C でも、反映済みの行と API 結果は書き出してから落とす（再実行で再課金しない）
+            for f in futs:
+                f.cancel()
+            save_station_cache(cache)
+            save_api_cache()
+            write_master_rows(rows, fields, dirty)
+            raise
+        finally:
+            for f in futs:
+                f.cancel()
+            if miss_f is not None:
+                miss_f.close()
 
     save_station_cache(cache)
+    save_api_cache()
 
-    if misses:
-        write_csv(
-            STATION_MISSES,
-            misses,
-            fieldnames=["facility_id","name","ward","reason","query_tried"],
-        )
-
-    write_master_rows(rows, fields)
+    if not write_master_rows(rows, fields, dirty):
+        print("master: no changes (not rewritten)")
 
     print("SUMMARY:")
     print(f"  - scanned={scanned}")
@@ -518,10 +1163,12 @@ def main() -> None:
     print(f"  - tried={tried}")
     print(f"  - updated_rows={updated_rows}")
     print(f"  - updated_cells={updated_cells}")
-    print(f"  - misses={len(misses)}")
+    print(f"  - misses={n_misses}")
+    print(f"  - api_cache_hit={_api_stats['hit']} api_cache_miss={_api_stats['miss']}")
+    print(f"  - memo_hit={_api_stats['memo']} station_without_api={_api_stats['station_local']}")
     print("DONE. wrote:", str(MASTER_CSV))
     print("station cache:", str(STATION_CACHE), "count:", len((cache.get("stations") or [])))
-    if misses:
+    if n_misses:
         print("misses file:", str(STATION_MISSES))
 
 if __name__ == "__main__":
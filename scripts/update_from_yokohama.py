@@ -3,22 +3,40 @@
 
 from __future__ import annotations
 
+import codecs
 import csv
+import html as htmllib
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+try:
+    import orjson  # 任意（入っていれば月次JSONの書き出しを高速化）
+except ImportError:
+    orjson = None
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ★ 追加：かな生成（API不要）
 from pykakasi import kakasi
 
 
 DATASET_PAGE = "https://data.city.yokohama.lg.jp/dataset/kodomo_nyusho-jokyo"
+# データセットページ中の CSV へのリンク（href="...csv"）
+_HREF_CSV_RE = re.compile(r"href\s*=\s*[\"']([^\"']+\.csv)[\"']", re.IGNORECASE)
+_CSV_URL_RE = re.compile(r"https?://[^\s\"']+\.csv")
+# 行ごとに使う正規表現はここで1回だけコンパイルする
+_WS_RE = re.compile(r"\s+")
+# 空白（全角スペース含む）を消す translate 表。\s と同じ文字集合で、最大は U+3000
+_WS_DEL = dict.fromkeys((c for c in range(0x3001) if chr(c).isspace()), None)
+_DIGITS_RE = re.compile(r"^\d{4,}$")
+# ヘッダ行の判定に使う語
+_HDR_KEYWORDS = ("施設", "区", "合計", "0歳", "０歳", "1歳", "１歳", "待ち", "受入", "児童")
 
 WARD_FILTER = (os.getenv("WARD_FILTER", "港北区") or "").strip()
 if WARD_FILTER == "":
@@ -28,6 +46,14 @@ ROOT = Path(__file__).resolve().parents[1]
 DATA_DIR = ROOT / "data"
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 MASTER_CSV = DATA_DIR / "master_facilities.csv"
+# データセットページの ETag / Last-Modified と、そこから拾った CSV URL（未更新なら再スクレイプしない）
+URL_CACHE = DATA_DIR / "yokohama_url_cache.json"
+
+# データセットページと CSV は同じホストなので keep-alive 接続を使い回す。5xx は数回だけ再送
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"]),
+))
 
 # ---- kana converter (hiragana) ----
 _kks = kakasi()
@@ -41,10 +67,7 @@ def hira(s: Any) -> str:
     s = s.strip()
     if not s:
         return ""
-    s = _conv.do(s)
-    s = s.replace("　", " ")
-    s = re.sub(r"\s+", "", s)
-    return s
+    return _conv.do(s).translate(_WS_DEL)
 
 def station_base(s: str) -> str:
     s = (s or "").strip()
@@ -54,11 +77,8 @@ def station_base(s: str) -> str:
 
 
 def norm(s: Any) -> str:
-    if s is None:
-        return ""
-    x = str(s).replace("　", " ")
-    x = re.sub(r"\s+", "", x)
-    return x.strip()
+    # 置換→正規表現→strip の3パスを translate 1パスに（空白は全部消えるので strip も不要）
+    return "" if s is None else str(s).translate(_WS_DEL)
 
 
 def to_int(x: Any) -> Optional[int]:
@@ -69,6 +89,9 @@ def to_int(x: Any) -> Optional[int]:
         return None
     if s in ("-", "－", "‐", "—", "―"):
         return 0
+    # ほとんどは整数そのままなので float を経由しない
+    if s.isdecimal():
+        return int(s)
     try:
         return int(float(s))
     except Exception:
@@ -86,10 +109,20 @@ def ratio_opt(wait: Optional[int], cap: Optional[int]) -> Optional[float]:
     return wait / cap
 
 
-def detect_month(rows: List[Dict[str, str]]) -> str:
+def col_index(header: List[str]) -> Dict[str, int]:
+    # 列名 → 列番号。同名列があれば後ろを採る（DictReader と同じ）
+    return {h: i for i, h in enumerate(header)}
+
+
+def cell(row: List[str], i: int) -> Optional[str]:
+    # 列が足りない行は DictReader と同じく None
+    return row[i] if i < len(row) else None
+
+
+def detect_month(rows: List[List[str]], cols: Dict[str, int]) -> str:
     if rows:
         for k in ("更新日", "更新年月日", "更新日時", "更新年月"):
-            v = str(rows[0].get(k, "")).strip()
+            v = str(cell(rows[0], cols[k])).strip() if k in cols else ""
             if v:
                 # "YYYY/MM/DD" などでも来るので正規化
                 v = v[:10].replace("/", "-")
@@ -102,20 +135,36 @@ def detect_month(rows: List[Dict[str, str]]) -> str:
     return date(today.year, today.month, 1).isoformat()
 
 
-def read_csv_from_url(url: str) -> List[Dict[str, str]]:
+def decode_csv_bytes(b: bytes) -> Optional[str]:
     """
-    タイトル行が先頭に入っているCSVでも、ヘッダ行を自動検出してDict化する。
+    BOM を見て、無ければ先頭 4KB だけで候補の文字コードを絞ってから本体を1回だけデコードする。
     """
-    r = requests.get(url, timeout=60)
-    r.raise_for_status()
-
-    for enc in ("cp932", "shift_jis", "utf-8-sig", "utf-8"):
+    if b.startswith(codecs.BOM_UTF8):
+        return b.decode("utf-8-sig")
+    head = b[:4096]
+    for enc in ("cp932", "shift_jis", "utf-8"):
         try:
-            text = r.content.decode(enc)
-            break
+            # 4KB の境界で2バイト文字が切れても失敗にしない（final=False）
+            codecs.getincrementaldecoder(enc)().decode(head, final=False)
         except UnicodeDecodeError:
             continue
-    else:
+        try:
+            return b.decode(enc)
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def read_csv_from_url(url: str) -> Tuple[List[str], List[List[str]]]:
+    """
+    タイトル行が先頭に入っているCSVでも、ヘッダ行を自動検出して (ヘッダ, 行リスト) で返す。
+    行は dict にせず list のまま持ち、列は col_index の番号で引く。
+    """
+    r = SESSION.get(url, timeout=60)
+    r.raise_for_status()
+
+    text = decode_csv_bytes(r.content)
+    if text is None:
         text = r.text
 
     lines = [ln for ln in text.splitlines() if ln is not None]
@@ -135,28 +184,33 @@ def read_csv_from_url(url: str) -> List[Dict[str, str]]:
             out.append(h2)
         return out
 
-    keywords = ("施設", "区", "合計", "0歳", "０歳", "1歳", "１歳", "待ち", "受入", "児童")
     best_idx = None
     best_score = -1
-    preview_rows: List[List[str]] = []
-
-    for i, row in enumerate(csv.reader(lines)):
-        if i > 80:
-            break
-        preview_rows.append(row)
-        nonempty = sum(1 for c in row if str(c).strip() != "")
-        has_kw = any(any(k in str(c) for k in keywords) for c in row)
+    # 全体を一度だけ parse し、ヘッダ判定もデータ取り出しも同じ行リストを使う
+    all_rows = list(csv.reader(lines))
+
+    preview = all_rows[:81]
+    # これ以上の点は取りようがない（全セルが埋まったキーワード入り行）
+    top_score = max((len(r) for r in preview), default=0) + 10
+
+    # csv.reader のセルは最初から str なので str() は通さない
+    for i, row in enumerate(preview):
+        nonempty = sum(1 for c in row if c.strip())
+        has_kw = any(k in c for c in row for k in _HDR_KEYWORDS)
         score = nonempty + (10 if has_kw else 0)
         if nonempty >= 5 and score > best_score:
             best_score = score
             best_idx = i
+            # 後ろの行が上回れない点なら、全行見たときと同じ結果なのでここで止める
+            if score == top_score:
+                break
 
     if best_idx is None:
-        return list(csv.DictReader(lines))
+        return (all_rows[0] if all_rows else []), [row for row in all_rows[1:] if row]
 
-    header = sanitize_header(preview_rows[best_idx])
-    data_lines = lines[best_idx + 1 :]
-    return list(csv.DictReader(data_lines, fieldnames=header))
+    header = sanitize_header(all_rows[best_idx])
+    # 空行は DictReader と同じく飛ばす
+    return header, [row for row in all_rows[best_idx + 1 :] if row]
 
 
 def scrape_csv_urls() -> Dict[str, str]:
@@ -164,12 +218,29 @@ def scrape_csv_urls() -> Dict[str, str]:
     accept(受入可能数) / wait(入所待ち人数) は必須
     enrolled(入所児童数) は見つかれば使う
     """
-    html = requests.get(DATASET_PAGE, timeout=30).text
-    soup = BeautifulSoup(html, "html.parser")
-
-    links = [a.get("href", "") for a in soup.select("a[href]") if a.get("href", "").endswith(".csv")]
+    cache: Dict[str, Any] = {}
+    if URL_CACHE.exists():
+        try:
+            cache = load_json(URL_CACHE.read_bytes())
+        except Exception:
+            cache = {}
+    headers = {}
+    if cache.get("urls"):
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    r = SESSION.get(DATASET_PAGE, timeout=30, headers=headers)
+    if r.status_code == 304 and cache.get("urls"):
+        print("CSV URLs (page not modified):", cache["urls"])
+        return cache["urls"]
+    html = r.text
+
+    # 欲しいのは .csv で終わる href だけなので、DOM は組み立てずに正規表現で拾う
+    links = [htmllib.unescape(u) for u in _HREF_CSV_RE.findall(html)]
     if not links:
-        links = re.findall(r"https?://[^\s\"']+\.csv", html)
+        links = _CSV_URL_RE.findall(html)
     links = list(dict.fromkeys(links))
 
     best: Dict[str, str] = {}
@@ -202,6 +273,9 @@ def scrape_csv_urls() -> Dict[str, str]:
         raise RuntimeError("CSVリンク抽出に失敗（ページ仕様変更の可能性）")
 
     print("CSV URLs:", best)
+    etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    if etag or last_modified:
+        URL_CACHE.write_bytes(dump_json({"etag": etag, "last_modified": last_modified, "urls": best}))
     return best
 
 
@@ -217,11 +291,11 @@ def load_master() -> Dict[str, Dict[str, str]]:
     return out
 
 
-def guess_facility_id_key(rows: List[Dict[str, str]]) -> str:
+def guess_facility_id_key(header: List[str], rows: List[List[str]]) -> str:
     if not rows:
         raise RuntimeError("CSVが空です")
 
-    header = list(rows[0].keys())
+    cols = col_index(header)
     print("DEBUG: header columns =", header)
 
     candidates = [
@@ -239,7 +313,7 @@ def guess_facility_id_key(rows: List[Dict[str, str]]) -> str:
         "事業所Ｎｏ",
     ]
     for k in candidates:
-        if k in rows[0]:
+        if k in cols:
             return k
 
     patterns = ("番号", "ID", "ＩＤ", "No", "Ｎｏ", "NO", "ＮＯ")
@@ -248,13 +322,13 @@ def guess_facility_id_key(rows: List[Dict[str, str]]) -> str:
             return k
 
     N = min(200, len(rows))
-    digit_re = re.compile(r"^\d{4,}$")
     best_key, best_score = None, -1
     for k in header:
+        j = cols[k]
         score = 0
         for i in range(N):
-            v = str(rows[i].get(k, "")).strip()
-            if digit_re.match(v):
+            v = str(cell(rows[i], j)).strip()
+            if _DIGITS_RE.match(v):
                 score += 1
         if score > best_score:
             best_key, best_score = k, score
@@ -266,93 +340,136 @@ def guess_facility_id_key(rows: List[Dict[str, str]]) -> str:
     raise RuntimeError("施設番号列が見つかりません（列名・中身推定ともに失敗）")
 
 
-def index_by_key(rows: List[Dict[str, str]], key: str) -> Dict[str, Dict[str, str]]:
-    out: Dict[str, Dict[str, str]] = {}
+def index_by_key(rows: List[List[str]], cols: Dict[str, int], key: str) -> Dict[str, List[str]]:
+    out: Dict[str, List[str]] = {}
+    j = cols.get(key)
+    if j is None:
+        return out
     for r in rows:
-        v = str(r.get(key, "")).strip()
+        v = str(cell(r, j)).strip()
         if v:
             out[v] = r
     return out
 
 
-def get_total(row: Dict[str, str]) -> Optional[int]:
-    if not row:
-        return None
-    if "合計" in row and str(row.get("合計", "")).strip() != "":
-        return to_int(row.get("合計"))
-    for k in row.keys():
-        if "合計" in k and str(row.get(k, "")).strip() != "":
-            return to_int(row.get(k))
-    return None
+def resolve_total_columns(cols: Dict[str, int]) -> List[int]:
+    # 「合計」ちょうど → 「合計」を含む列の順に、見る列番号をCSVごとに1回だけ決める
+    out = [cols["合計"]] if "合計" in cols else []
+    out += [j for k, j in cols.items() if "合計" in k]
+    return list(dict.fromkeys(out))
 
 
-def get_age_value(row: Dict[str, str], age: int) -> Optional[int]:
+_ZEN2HAN = str.maketrans("０１２３４５", "012345")
+
+
+def resolve_age_columns(cols: Dict[str, int]) -> Dict[int, List[int]]:
+    # 0〜5歳それぞれについて、見る列番号を候補順に並べておく（行ごとの列名走査をなくす）
+    # 列名の全角数字は先に半角へ寄せるので、照合パターンは半角だけでよい
+    han = [(k.translate(_ZEN2HAN), j) for k, j in cols.items()]
+    out: Dict[int, List[int]] = {}
+    for age in range(6):
+        base = f"{age}歳"
+        idx = [j for k, j in han if k == base + "児"]
+        idx += [j for k, j in han if k == base]
+        idx += [j for k, j in han if base in k]
+        out[age] = list(dict.fromkeys(idx))
+    return out
+
+
+def first_value(row: List[str], idx: List[int]) -> Optional[int]:
+    # 候補列のうち最初に値が入っている列を数値で返す
     if not row:
         return None
-    z = "０１２３４５"
-    pats = [f"{age}歳児", f"{age}歳", z[age] + "歳児", z[age] + "歳"]
-    for p in pats:
-        if p in row and str(row.get(p, "")).strip() != "":
-            return to_int(row.get(p))
-    for k in row.keys():
-        if any(p in k for p in pats) and str(row.get(k, "")).strip() != "":
-            return to_int(row.get(k))
+    for j in idx:
+        v = cell(row, j)
+        if str(v).strip() != "":
+            return to_int(v)
     return None
 
 
+def get_total(row: List[str], total_cols: List[int]) -> Optional[int]:
+    return first_value(row, total_cols)
+
+
+def get_age_value(row: List[str], age_cols: Dict[int, List[int]], age: int) -> Optional[int]:
+    return first_value(row, age_cols[age])
+
+
 def build_map_url(name: str, ward: str, address: str = "", lat: str = "", lng: str = "") -> str:
     if lat and lng:
         return f"https://www.google.com/maps/search/?api=1&query={lat},{lng}"
     q = " ".join([name, address, ward, "横浜市"]).strip()
-    q = re.sub(r"\s+", " ", q)
+    q = _WS_RE.sub(" ", q)
     return f"https://www.google.com/maps/search/?api=1&query={q}"
 
 
-def pick_ward_key(row: Dict[str, str]) -> Optional[str]:
+def pick_ward_key(cols: Dict[str, int]) -> Optional[str]:
     for k in ("施設所在区", "所在区", "区名"):
-        if k in row:
+        if k in cols:
             return k
-    for k in row.keys():
+    for k in cols:
         if "区" in k:
             return k
     return None
 
 
-def pick_name_key(row: Dict[str, str]) -> Optional[str]:
+def pick_name_key(cols: Dict[str, int]) -> Optional[str]:
     for k in ("施設名", "施設・事業名", "施設・事業所名", "事業名"):
-        if k in row:
+        if k in cols:
             return k
-    for k in row.keys():
+    for k in cols:
         if "施設" in k and "区" not in k:
             return k
     return None
 
 
+def load_json(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+
+def dump_json(obj: Any) -> bytes:
+    # orjson でも json でも同じ出力（2スペースインデント・非ASCIIはそのまま）になるようにする
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
 def main() -> None:
     print("START update_from_yokohama.py  WARD_FILTER=", WARD_FILTER)
 
     urls = scrape_csv_urls()
-    accept_rows = read_csv_from_url(urls["accept"])
-    wait_rows = read_csv_from_url(urls["wait"])
-
-    enrolled_rows: List[Dict[str, str]] = []
-    if "enrolled" in urls:
-        try:
-            enrolled_rows = read_csv_from_url(urls["enrolled"])
-        except Exception as e:
-            print("WARN: enrolled read failed:", e)
-
-    month = detect_month(accept_rows)
+    # 3本の CSV は独立なので同時に取りに行く（待ち時間は合計ではなく最長の1本分）
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        futs = {kind: ex.submit(read_csv_from_url, url) for kind, url in urls.items()}
+        accept_hdr, accept_rows = futs["accept"].result()
+        wait_hdr, wait_rows = futs["wait"].result()
+
+        enrolled_hdr: List[str] = []
+        enrolled_rows: List[List[str]] = []
+        if "enrolled" in futs:
+            try:
+                enrolled_hdr, enrolled_rows = futs["enrolled"].result()
+            except Exception as e:
+                print("WARN: enrolled read failed:", e)
+
+    ac, wc, ec = col_index(accept_hdr), col_index(wait_hdr), col_index(enrolled_hdr)
+    # 合計・年齢別の列はヘッダだけで決まるので、施設ループの前に解決しておく
+    a_tot, w_tot, e_tot = resolve_total_columns(ac), resolve_total_columns(wc), resolve_total_columns(ec)
+    a_age, w_age, e_age = resolve_age_columns(ac), resolve_age_columns(wc), resolve_age_columns(ec)
+
+    month = detect_month(accept_rows, ac)
     print("Detected month:", month)
 
-    fid_key = guess_facility_id_key(accept_rows)
-    A = index_by_key(accept_rows, fid_key)
+    fid_key = guess_facility_id_key(accept_hdr, accept_rows)
+    A = index_by_key(accept_rows, ac, fid_key)
 
-    W = index_by_key(wait_rows, fid_key) if wait_rows and fid_key in wait_rows[0] else {}
-    E = index_by_key(enrolled_rows, fid_key) if enrolled_rows and fid_key in enrolled_rows[0] else {}
+    W = index_by_key(wait_rows, wc, fid_key) if wait_rows and fid_key in wc else {}
+    E = index_by_key(enrolled_rows, ec, fid_key) if enrolled_rows and fid_key in ec else {}
 
-    ward_key = pick_ward_key(accept_rows[0]) if accept_rows else None
-    name_key = pick_name_key(accept_rows[0]) if accept_rows else None
+    ward_key = pick_ward_key(ac) if accept_rows else None
+    name_key = pick_name_key(ac) if accept_rows else None
     print("DEBUG: fid_key =", fid_key, "ward_key =", ward_key, "name_key =", name_key)
 
     master = load_master()
@@ -361,16 +478,16 @@ def main() -> None:
     facilities: List[Dict[str, Any]] = []
 
     for fid, ar in A.items():
-        ward = norm(ar.get(ward_key)) if ward_key else ""
+        ward = norm(cell(ar, ac[ward_key])) if ward_key else ""
         ward = ward.replace("横浜市", "")
 
         if target and target not in ward:
             continue
 
-        wr = W.get(fid, {})
-        er = E.get(fid, {})
+        wr = W.get(fid, [])
+        er = E.get(fid, [])
 
-        name = str(ar.get(name_key, "")).strip() if name_key else ""
+        name = str(cell(ar, ac[name_key])).strip() if name_key else ""
 
         m = master.get(fid, {})
 
@@ -400,18 +517,18 @@ def main() -> None:
         if not station_kana and nearest_station:
             station_kana = hira(station_base(nearest_station))
 
-        tot_accept = get_total(ar)
-        tot_wait = get_total(wr) if wr else None
-        tot_enrolled = get_total(er) if er else None
+        tot_accept = get_total(ar, a_tot)
+        tot_wait = get_total(wr, w_tot) if wr else None
+        tot_enrolled = get_total(er, e_tot) if er else None
 
         tot_capacity_est = (tot_enrolled + tot_accept) if (tot_enrolled is not None and tot_accept is not None) else None
         tot_wait_per_capacity_est = ratio_opt(tot_wait, tot_capacity_est)
 
         ages_0_5: Dict[str, Dict[str, Any]] = {}
         for i in range(6):
-            a = get_age_value(ar, i)
-            w = get_age_value(wr, i) if wr else None
-            e = get_age_value(er, i) if er else None
+            a = get_age_value(ar, a_age, i)
+            w = get_age_value(wr, w_age, i) if wr else None
+            e = get_age_value(er, e_age, i) if er else None
             cap_est = (e + a) if (e is not None and a is not None) else None
             ages_0_5[str(i)] = {
                 "accept": a,
@@ -479,27 +596,30 @@ def main() -> None:
         raise RuntimeError("facilitiesが0件です（区フィルタ/列名不一致の可能性）")
 
     month_path = DATA_DIR / f"{month}.json"
-    month_path.write_text(
-        json.dumps({"month": month, "ward": (WARD_FILTER or "横浜市"), "facilities": facilities}, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    month_path.write_bytes(dump_json({"month": month, "ward": (WARD_FILTER or "横浜市"), "facilities": facilities}))
     if month_path.stat().st_size < 200:
         raise RuntimeError("月次JSONが小さすぎます（生成失敗の可能性）")
 
     months_path = DATA_DIR / "months.json"
     months = {"months": [month]}
+    old_months = None
     if months_path.exists():
         try:
-            old_txt = months_path.read_text(encoding="utf-8").strip()
-            old = json.loads(old_txt) if old_txt else {}
-            ms = set(old.get("months", []))
+            old_raw = months_path.read_bytes().strip()
+            old = load_json(old_raw) if old_raw else {}
+            old_months = old.get("months", [])
+            ms = set(old_months)
             ms.add(month)
             months["months"] = sorted(ms)
         except Exception:
             months = {"months": [month]}
 
-    months_path.write_text(json.dumps(months, ensure_ascii=False, indent=2), encoding="utf-8")
-    print("WROTE:", month_path.name, "and months.json")
+    # 既に載っている月の再実行なら months.json は書き直さない
+    if months["months"] != old_months:
+        months_path.write_bytes(dump_json(months))
+        print("WROTE:", month_path.name, "and months.json")
+    else:
+        print("WROTE:", month_path.name, "(months.json unchanged)")
 
 
 if __name__ == "__main__":